@@ -2,108 +2,100 @@ import streamlit as st
 import pickle
 import pandas as pd
 import numpy as np
-import requests
+import asyncio
 import os
+import importlib.util
 import subprocess
-from datetime import datetime, timedelta, timezone
+from datetime import timedelta
+from model import make_feature_extractor
+from usgs import USGS_SITES, LAG_HOURS, usgs_session, fetch_json, series_by_creek, purge_usgs_cache, fetch_real_time_data, historical_url
 
 st.set_page_config(page_title="Sugar Creek Data Lookup", page_icon="🎣")
 
-# Ensure xgboost is installed
-try:
-    import xgboost
-except ModuleNotFoundError:
+# Ensure xgboost is installed (only locate it here; unpickling the model imports it)
+if importlib.util.find_spec("xgboost") is None:
     st.warning("⚠️ XGBoost not found. Installing now...")
     subprocess.run(["pip", "install", "xgboost"], check=True)
-    import xgboost
+    importlib.invalidate_caches()
     st.success("✅ XGBoost installed successfully!")
 
 # Get the absolute path of the script's directory
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 MODEL_PATH = os.path.join(BASE_DIR, "scpm2.pkl")
 
-# Load the model safely
-try:
+# Load the model and its feature extractor once and reuse them across Streamlit reruns
+# (feature names are kept as plain strings so the generated lookups stay cheap)
+@st.cache_resource
+def load_model():
     with open(MODEL_PATH, "rb") as file:
         xgb_model = pickle.load(file)
+    return xgb_model, make_feature_extractor(tuple(str(feature) for feature in xgb_model.feature_names_in_))
+
+# Load the model safely
+try:
+    xgb_model, extract_features = load_model()
     st.success("Model loaded successfully!")
 except FileNotFoundError:
     st.error("Error: Model file 'scpm2.pkl' not found. Ensure it's in the root directory.")
 
-# USGS API URLs for real-time data
-USGS_SITES = {
-    "Shoal_Creek": "03588500",
-    "Big_Nance_Creek": "03586500",
-    "Limestone_Creek": "03576250",
-    "Swan_Creek": "03577225",
-}
-
-# Function to fetch real-time USGS CFS readings and timestamps
-def fetch_real_time_data():
-    real_time_values = {}
-    timestamps = {}
+# Function to pick the reading closest to the target timestamp out of a USGS time series
+def closest_reading(time_series, target_timestamp):
+    if time_series is None:
+        return np.nan, "N/A"
 
-    for creek, site in USGS_SITES.items():
-        url = f"https://waterservices.usgs.gov/nwis/iv/?format=json&sites={site}&parameterCd=00060"
-        response = requests.get(url, headers={"Accept": "application/json"})
+    try:
+        values = time_series["values"][0]["value"]
+        
+        # Parse all timestamps in one vectorized pass; USGS returns them in time order,
+        # so binary-search for the target and compare only its two neighbours
+        entry_times = pd.to_datetime([entry["dateTime"] for entry in values], format="ISO8601", utc=True)
+        after = entry_times.searchsorted(target_timestamp)
+        neighbours = [i for i in (after - 1, after) if 0 <= i < len(entry_times)]
+        closest = min(neighbours, key=lambda i: abs(entry_times[i] - target_timestamp))
         
-        if response.status_code == 200:
-            try:
-                data = response.json()
-                time_series = data["value"]["timeSeries"][0]
-                latest_value_entry = time_series["values"][0]["value"][0]
-                
-                real_time_values[creek] = float(latest_value_entry["value"])
-                raw_timestamp = latest_value_entry["dateTime"]
-                
-                # Convert timezone-aware timestamp to UTC
-                parsed_timestamp = datetime.strptime(raw_timestamp, "%Y-%m-%dT%H:%M:%S.%f%z")
-                formatted_timestamp = parsed_timestamp.strftime("%m/%d/%Y %I:%M %p")
+        closest_value = float(values[closest]["value"])
+        closest_time = entry_times[closest].to_pydatetime().astimezone().strftime("%m/%d/%Y %I:%M %p")
+        return closest_value, closest_time
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        return np.nan, "N/A"
 
-                timestamps[creek] = formatted_timestamp
-            except (KeyError, IndexError, TypeError, ValueError) as e:
-                real_time_values[creek] = np.nan
-                timestamps[creek] = "N/A"
-        else:
-            real_time_values[creek] = np.nan
-            timestamps[creek] = "N/A"
+# Function to fetch historical lag values using each creek's real-time reading time as reference
+async def fetch_historical_data(session, reading_times):
+    reference_timestamps = {creek: reading_time for creek, reading_time in reading_times.items() if reading_time is not None}
+    if not reference_timestamps:
+        return {}, {}
 
-    return real_time_values, timestamps
+    # One multi-site request per lag, all fetched in the same batch
+    sites = [USGS_SITES[creek] for creek in reference_timestamps]
+    urls = [
+        historical_url([reference - timedelta(hours=hours_ago) for reference in reference_timestamps.values()], sites)
+        for hours_ago in LAG_HOURS.values()
+    ]
+    responses = await asyncio.gather(*(fetch_json(session, url) for url in urls))
+    lag_series = [series_by_creek(data) for data in responses]
 
-# Function to fetch historical lag values using the real-time timestamp as reference
-def fetch_historical_data(site, reference_timestamp, hours_ago):
-    if isinstance(reference_timestamp, str):
-        reference_timestamp = datetime.strptime(reference_timestamp, "%m/%d/%Y %I:%M %p").astimezone(timezone.utc)
-    target_timestamp = reference_timestamp - timedelta(hours=hours_ago)
-    start_time = (target_timestamp - timedelta(minutes=30)).strftime('%Y-%m-%dT%H:%M:%SZ')
-    end_time = (target_timestamp + timedelta(minutes=30)).strftime('%Y-%m-%dT%H:%M:%SZ')
-    
-    url = f"https://waterservices.usgs.gov/nwis/iv/?format=json&sites={site}&parameterCd=00060&startDT={start_time}&endDT={end_time}"
-    response = requests.get(url, headers={"Accept": "application/json"})
-    
-    if response.status_code == 200:
-        try:
-            data = response.json()
-            time_series = data["value"]["timeSeries"][0]
-            values = time_series["values"][0]["value"]
-            
-            closest_value, closest_time = np.nan, "N/A"
-            min_time_diff = float("inf")
-            
-            for entry in values:
-                entry_time = datetime.strptime(entry["dateTime"], "%Y-%m-%dT%H:%M:%S.%f%z").astimezone(timezone.utc)
-                time_diff = abs((entry_time - target_timestamp).total_seconds())
-                
-                if time_diff < min_time_diff:
-                    min_time_diff = time_diff
-                    closest_value = float(entry["value"])
-                    closest_time = entry_time.astimezone().strftime("%m/%d/%Y %I:%M %p")
-            
-            return closest_value, closest_time
-        except (KeyError, IndexError, TypeError, ValueError) as e:
-            return np.nan, "N/A"
-    else:
-        return np.nan, "N/A"
+    lag_data = {}
+    lag_timestamps = {}
+    for creek, reference_timestamp in reference_timestamps.items():
+        for (lag, hours_ago), series in zip(LAG_HOURS.items(), lag_series):
+            key = f"{creek}_{lag}"
+            lag_data[key], lag_timestamps[key] = closest_reading(series.get(creek), reference_timestamp - timedelta(hours=hours_ago))
+
+    return lag_data, lag_timestamps
+
+# Function to fetch real-time readings and then their lag values over one shared USGS session
+async def fetch_model_data():
+    async with usgs_session() as session:
+        real_time_data, reading_times = await fetch_real_time_data(session)
+        lag_data, lag_timestamps = await fetch_historical_data(session, reading_times)
+        await purge_usgs_cache(session)
+
+    # Reading times are shown as USGS reports them, in the site's local time
+    timestamps = {
+        creek: reading_time.strftime("%m/%d/%Y %I:%M %p") if reading_time is not None else "N/A"
+        for creek, reading_time in reading_times.items()
+    }
+    return real_time_data, timestamps, lag_data, lag_timestamps
 
 st.title("Sugar Creek CFS Prediction")
 st.write("### Predicting Sugar Creek's Flow Using Real-Time USGS Data")
@@ -111,17 +103,7 @@ st.write("### Predicting Sugar Creek's Flow Using Real-Time USGS Data")
 if st.button("Get Prediction"):
     st.write("Fetching Real-Time and Historical Data from USGS...")
     
-    real_time_data, timestamps = fetch_real_time_data()
-    
-    lag_data = {}
-    lag_timestamps = {}
-    
-    for creek, site in USGS_SITES.items():
-        if timestamps[creek] != "N/A":
-            reference_timestamp = datetime.strptime(timestamps[creek], "%m/%d/%Y %I:%M %p").astimezone(timezone.utc)
-            lag_data[f"{creek}_Lag1"], lag_timestamps[f"{creek}_Lag1"] = fetch_historical_data(site, reference_timestamp, 24)
-            lag_data[f"{creek}_Lag3"], lag_timestamps[f"{creek}_Lag3"] = fetch_historical_data(site, reference_timestamp, 72)
-            lag_data[f"{creek}_Lag7"], lag_timestamps[f"{creek}_Lag7"] = fetch_historical_data(site, reference_timestamp, 168)
+    real_time_data, timestamps, lag_data, lag_timestamps = asyncio.run(fetch_model_data())
     
     with st.expander("🌊 USGS CFS Readings at Selected Time"):
         for creek, value in real_time_data.items():
@@ -131,9 +113,9 @@ if st.button("Get Prediction"):
         for key, value in lag_data.items():
             st.write(f"**{key.replace('_', ' ')}**: {value} CFS *(Recorded at: {lag_timestamps[key]})*")
     
-    model_input = pd.DataFrame([{**real_time_data, **lag_data}])
-    model_input = model_input[[col for col in xgb_model.feature_names_in_]]
-    prediction = xgb_model.predict(model_input)[0]
+    # Build the single model row as a float32 array in the model's feature order
+    model_input = extract_features({**real_time_data, **lag_data})
+    prediction = xgb_model.get_booster().inplace_predict(model_input)[0]
     
     st.write("### 📊 **Predicted Sugar Creek CFS**")
     st.success(f"Predicted Flow: {prediction:.2f} CFS")
@@ -0,0 +1,14 @@
+import os
+from model import load_booster
+
+# 🔹 Export the booster inside scpm2.pkl to XGBoost's native UBJSON format (scpm2.ubj).
+# record_real_time.py loads the .ubj straight into an xgboost.Booster, skipping the
+# pickled sklearn wrapper, and re-exports it itself whenever scpm2.pkl changes; run this
+# after retraining to refresh the export ahead of time:
+#     python convert_model.py
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_PATH = os.path.join(BASE_DIR, "scpm2.pkl")
+BOOSTER_PATH = os.path.join(BASE_DIR, "scpm2.ubj")
+
+load_booster(MODEL_PATH, BOOSTER_PATH)
+print(f"✅ Exported {MODEL_PATH} to {BOOSTER_PATH}")
@@ -0,0 +1,39 @@
+import hashlib
+import os
+import pickle
+import numpy as np
+
+# 🔹 Model helpers shared by the Streamlit pages and record_real_time.py
+
+# 🔹 Generate the row builder that turns a feature dict into the 1×N float32 model input.
+# The feature order is fixed once the model loads, so the lookups are written out as
+# straight-line code instead of looping over the feature names on every prediction;
+# features missing from the dict are passed as NaN.
+def make_feature_extractor(features):
+    lookups = ", ".join(f"get({feature!r}, nan)" for feature in features)
+    source = f"def extract_features(data):\n    get = data.get\n    return np.array([[{lookups}]], dtype=np.float32)\n"
+    namespace = {"np": np, "nan": np.nan}
+    exec(source, namespace)
+    return namespace["extract_features"]
+
+# 🔹 Load the XGBoost booster from its native UBJSON export, (re)exporting it from the
+# pickled model first if the export is missing or was built from a different pickle.
+# The pickle's SHA-256 is stored in the export as a booster attribute, so the check holds
+# however a checkout or restored cache left the files' modification times.
+def load_booster(pickle_path, export_path):
+    import xgboost as xgb
+
+    with open(pickle_path, "rb") as file:
+        pickled = file.read()
+    digest = hashlib.sha256(pickled).hexdigest()
+
+    if os.path.exists(export_path):
+        booster = xgb.Booster()
+        booster.load_model(export_path)
+        if booster.attr("pickle_sha256") == digest:
+            return booster
+
+    booster = pickle.loads(pickled).get_booster()
+    booster.set_attr(pickle_sha256=digest)
+    booster.save_model(export_path)
+    return booster
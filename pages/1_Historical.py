@@ -2,9 +2,11 @@ import streamlit as st
 import pickle
 import pandas as pd
 import numpy as np
-import requests
+import asyncio
 import os
 from datetime import datetime, timedelta, timezone
+from model import make_feature_extractor
+from usgs import USGS_SITES, ALL_SITES, HISTORICAL_URL_TEMPLATE, usgs_session, fetch_json, series_by_creek, purge_usgs_cache
 
 # ✅ Set page title and icon for Streamlit multipage app
 st.set_page_config(page_title="Historical Lookup", page_icon="⏰")
@@ -14,42 +16,50 @@ st.title("Sugar Creek Historical Lookup")
 # ✅ Load the trained XGBoost model (Ensure correct path)
 MODEL_PATH = os.path.join(os.path.dirname(__file__), "..", "scpm2.pkl")
 
-# Load the model safely
-try:
+# Load the model and its feature extractor once and reuse them across Streamlit reruns
+# (feature names are kept as plain strings so the generated lookups stay cheap)
+@st.cache_resource
+def load_model():
     with open(MODEL_PATH, "rb") as file:
         xgb_model = pickle.load(file)
+    return xgb_model, make_feature_extractor(tuple(str(feature) for feature in xgb_model.feature_names_in_))
+
+# Load the model safely
+try:
+    xgb_model, extract_features = load_model()
     st.success("Model loaded successfully!")
 except FileNotFoundError:
     st.error("Error: Model file 'scpm2.pkl' not found. Ensure it's in the root directory.")
 
-# USGS API URLs for real-time data
-USGS_SITES = {
-    "Shoal_Creek": "03588500",
-    "Big_Nance_Creek": "03586500",
-    "Limestone_Creek": "03576250",
-    "Swan_Creek": "03577225",
-}
+# Days before the selected time for each reading, keyed by model feature suffix
+LAG_DAYS = {"": 0, "_Lag1": 1, "_Lag3": 3, "_Lag7": 7}
 
-# Function to fetch historical CFS data from USGS
+# Function to fetch historical CFS data for every site from USGS in one request
+async def fetch_usgs_data(session, target_timestamp):
+    url = HISTORICAL_URL_TEMPLATE.format(sites=ALL_SITES, start=target_timestamp, end=target_timestamp)
+    series = series_by_creek(await fetch_json(session, url))
+    site_values = {creek: np.nan for creek in USGS_SITES}
 
-def fetch_usgs_data(site, target_timestamp):
-    url = f"https://waterservices.usgs.gov/nwis/iv/?format=json&sites={site}&parameterCd=00060&startDT={target_timestamp}&endDT={target_timestamp}"
-    response = requests.get(url, headers={"Accept": "application/json"})
-    
-    if response.status_code == 200:
+    # A malformed series only leaves its own creek missing
+    for creek, time_series in series.items():
         try:
-            data = response.json()
-            time_series = data["value"]["timeSeries"][0]
             values = time_series["values"][0]["value"]
-            
-            closest_value = float(values[-1]["value"]) if values else np.nan
-            return closest_value
+            site_values[creek] = float(values[-1]["value"]) if values else np.nan
         except (KeyError, IndexError, TypeError, ValueError) as e:
-            print(f"⚠️ Error fetching USGS data for site {site}: {e}")
-            return np.nan
-    else:
-        print(f"❌ Failed to fetch USGS data for site {site}. HTTP Status: {response.status_code}")
-        return np.nan
+            print(f"⚠️ Error fetching USGS data for {creek} at {target_timestamp}: {e}")
+
+    return site_values
+
+# Function to fetch every (feature suffix, timestamp) request concurrently
+async def fetch_all_usgs_data(target_timestamps):
+    async with usgs_session() as session:
+        responses = await asyncio.gather(*(fetch_usgs_data(session, target_timestamp) for target_timestamp in target_timestamps.values()))
+        await purge_usgs_cache(session)
+    return {
+        f"{creek}{suffix}": site_values[creek]
+        for creek in USGS_SITES
+        for suffix, site_values in zip(target_timestamps, responses)
+    }
 
 # Streamlit UI - User Inputs
 st.write("### Enter a Past Date and Time to Predict Sugar Creek's Flow")
@@ -85,57 +95,40 @@ selected_datetime = datetime.combine(selected_date, datetime.min.time()).replace
 # Convert to UTC (assuming input is local time)
 selected_datetime_utc = selected_datetime.astimezone(timezone.utc)
 
-# Explicitly format UTC before sending to USGS API
-usgs_formatted_datetime = selected_datetime_utc.strftime('%Y-%m-%dT%H:%M:%SZ')
-
-# Compute Lag1, Lag3, and Lag7 timestamps using UTC
-lag1_datetime_utc = (selected_datetime_utc - timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
-lag3_datetime_utc = (selected_datetime_utc - timedelta(days=3)).strftime('%Y-%m-%dT%H:%M:%SZ')
-lag7_datetime_utc = (selected_datetime_utc - timedelta(days=7)).strftime('%Y-%m-%dT%H:%M:%SZ')
+# Compute the selected, Lag1, Lag3, and Lag7 timestamps together and format each set once:
+# explicitly in UTC for the USGS API, and in local time for display
+lag_offsets = pd.to_timedelta(list(LAG_DAYS.values()), unit="D")
+usgs_timestamps = dict(zip(LAG_DAYS, (pd.Timestamp(selected_datetime_utc) - lag_offsets).strftime('%Y-%m-%dT%H:%M:%SZ')))
+display_timestamps = dict(zip(LAG_DAYS, (pd.Timestamp(selected_datetime) - lag_offsets).strftime('%m/%d/%Y at %I:%M %p')))
 
 # Debugging Output
 with st.expander("📊 Debugging & Logged Data"):
     st.write("#### Selected Inputs & Converted Timestamps")
     st.write(f"Selected Datetime (Local): {selected_datetime}")
     st.write(f"Selected Datetime (UTC for USGS API): {selected_datetime_utc}")  # ✅ Explicit UTC Conversion
-    st.write(f"USGS Formatted Datetime: {usgs_formatted_datetime}")  # ✅ Ensuring UTC before API call
-    st.write(f"Lag1 Datetime (UTC for USGS API): {lag1_datetime_utc}")
-    st.write(f"Lag3 Datetime (UTC for USGS API): {lag3_datetime_utc}")
-    st.write(f"Lag7 Datetime (UTC for USGS API): {lag7_datetime_utc}")
+    st.write(f"USGS Formatted Datetime: {usgs_timestamps['']}")  # ✅ Ensuring UTC before API call
+    for suffix in ("_Lag1", "_Lag3", "_Lag7"):
+        st.write(f"{suffix[1:]} Datetime (UTC for USGS API): {usgs_timestamps[suffix]}")
 
 # Button to fetch USGS data
 if st.button("Fetch Historic Data"):
     st.write("Fetching historical data for the selected timestamp...")
     
     # Fetch USGS data for selected and lag timestamps
-    real_time_data = {}
-    for creek, site in USGS_SITES.items():
-        real_time_data[creek] = fetch_usgs_data(site, usgs_formatted_datetime)
-        real_time_data[f"{creek}_Lag1"] = fetch_usgs_data(site, lag1_datetime_utc)
-        real_time_data[f"{creek}_Lag3"] = fetch_usgs_data(site, lag3_datetime_utc)
-        real_time_data[f"{creek}_Lag7"] = fetch_usgs_data(site, lag7_datetime_utc)
-
-    # Prepare data for prediction
-    model_input = pd.DataFrame([{**real_time_data}])
+    real_time_data = asyncio.run(fetch_all_usgs_data(usgs_timestamps))
 
-    # Ensure column order matches the trained model
-    model_input = model_input[[col for col in xgb_model.feature_names_in_]]
+    # Prepare data for prediction as a float32 row in the model's feature order
+    model_input = extract_features(real_time_data)
 
     # Run prediction
-    prediction = xgb_model.predict(model_input)[0]
+    prediction = xgb_model.get_booster().inplace_predict(model_input)[0]
     
     # Display fetched values
     with st.expander("🌊 USGS CFS Readings at Selected Time"):
-        for creek, value in real_time_data.items():
-            # Determine appropriate timestamp for each entry
-            timestamp = selected_datetime.strftime('%m/%d/%Y at %I:%M %p')
-            if 'Lag1' in creek:
-                timestamp = (selected_datetime - timedelta(days=1)).strftime('%m/%d/%Y at %I:%M %p')
-            elif 'Lag3' in creek:
-                timestamp = (selected_datetime - timedelta(days=3)).strftime('%m/%d/%Y at %I:%M %p')
-            elif 'Lag7' in creek:
-                timestamp = (selected_datetime - timedelta(days=7)).strftime('%m/%d/%Y at %I:%M %p')
-            st.write(f"**{creek.replace('_', ' ')}**: {value} CFS (Recorded at: {timestamp})")
+        for creek in USGS_SITES:
+            for suffix, timestamp in display_timestamps.items():
+                key = f"{creek}{suffix}"
+                st.write(f"**{key.replace('_', ' ')}**: {real_time_data[key]} CFS (Recorded at: {timestamp})")
     
     # Display prediction result
     st.success(f"Predicted Flow: {prediction:.2f} CFS on {selected_date_str} at {selected_hour}:{selected_minute} {am_pm}")
@@ -1,8 +1,5 @@
 import streamlit as st
-import gspread
 import pandas as pd
-import plotly.express as px
-from oauth2client.service_account import ServiceAccountCredentials
 
 # 🔹 Page Configuration
 st.set_page_config(page_title="Graphed Trends", page_icon="📈")
@@ -14,31 +11,43 @@ st.write("### Live Graph of Predicted CFS from Google Sheets")
 SHEET_NAME = "sugar_creek_data"
 CREDENTIALS_FILE = "gspread_credentials.json"  # Ensure this is in your repo!
 
-# 🔹 Authenticate with Google Sheets
-scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-creds = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_FILE, scope)
-client = gspread.authorize(creds)
-sheet = client.open(SHEET_NAME).sheet1  # Open the first sheet
+# 🔹 Authenticate with Google Sheets once per session instead of on every rerun
+@st.cache_resource
+def get_sheet():
+    import gspread
 
-# 🔹 Fetch Data
-data = sheet.get_all_values()
-df = pd.DataFrame(data[1:], columns=data[0])  # Use the first row as column headers
+    client = gspread.service_account(filename=CREDENTIALS_FILE)
+    return client.open(SHEET_NAME).sheet1  # Open the first sheet
+
+# 🔹 Re-download and parse the sheet at most once a minute
+@st.cache_data(ttl=60)
+def load_sheet():
+    data = get_sheet().get_all_values()
+    df = pd.DataFrame(data[1:], columns=data[0])  # Use the first row as column headers
+
+    # 🔹 Convert Timestamp Column to Datetime (explicit format skips per-row inference)
+    df["Timestamp (UTC)"] = pd.to_datetime(df["Timestamp (UTC)"], format="ISO8601", cache=True)
 
-# 🔹 Convert Timestamp Column to Datetime
-df["Timestamp (UTC)"] = pd.to_datetime(df["Timestamp (UTC)"])
+    # 🔹 Convert Prediction Column to Numeric
+    df["Predicted Sugar Creek CFS"] = pd.to_numeric(df["Predicted Sugar Creek CFS"], errors="coerce")
 
-# 🔹 Convert Prediction Column to Numeric
-df["Predicted Sugar Creek CFS"] = pd.to_numeric(df["Predicted Sugar Creek CFS"], errors="coerce")
+    # 🔹 Sort Data by Time
+    return df.sort_values("Timestamp (UTC)")
 
-# 🔹 Sort Data by Time
-df = df.sort_values("Timestamp (UTC)")
+# 🔹 Fetch Data
+df = load_sheet()
 
 # 🔹 Display Data
 st.write("### 🔍 Latest Data Entries")
 st.dataframe(df.tail(10))  # Show the last 10 records
 
-# 🔹 Plot the Data
-fig = px.line(df, x="Timestamp (UTC)", y="Predicted Sugar Creek CFS", title="Sugar Creek CFS Predictions Over Time")
+# 🔹 Plot the Data (plotly is only imported once there is a chart to draw)
+def plot_predictions(df):
+    import plotly.express as px
+
+    return px.line(df, x="Timestamp (UTC)", y="Predicted Sugar Creek CFS", title="Sugar Creek CFS Predictions Over Time")
+
+fig = plot_predictions(df)
 
 st.plotly_chart(fig, use_container_width=True)
 
@@ -1,144 +1,239 @@
 import os
-import pickle
-import pandas as pd
+import math
 import numpy as np
-import requests
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-import xgboost as xgb
-import pytz
-from datetime import datetime, timezone, timedelta
+import asyncio
+import shelve
+import time
+from functools import lru_cache
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from model import make_feature_extractor, load_booster
+from usgs import USGS_SITES, LAG_HOURS, usgs_session, fetch_json, series_by_creek, fetch_real_time_data, historical_url
 
 # 🔹 Google Sheets Configuration
 SHEET_NAME = "sugar_creek_data"
 CREDENTIALS_FILE = "gspread_credentials.json"
 
-# 🔹 Load Google Sheets Credentials
-scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-creds = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_FILE, scope)
-client = gspread.authorize(creds)
-sheet = client.open(SHEET_NAME).sheet1  # Open the first sheet
-
-# 🔹 Load the trained XGBoost model
-MODEL_PATH = os.path.join(os.path.dirname(__file__), "scpm2.pkl")
-
-try:
-    with open(MODEL_PATH, "rb") as file:
-        xgb_model = pickle.load(file)
-except FileNotFoundError:
-    print("❌ Model file 'scpm2.pkl' not found.")
-    exit(1)
-
-# 🔹 USGS Creek Sites (same ones used in the model)
-USGS_SITES = {
-    "Shoal_Creek": "03588500",
-    "Big_Nance_Creek": "03586500",
-    "Limestone_Creek": "03576250",
-    "Swan_Creek": "03577225",
-}
-
-# 🔹 Function to fetch real-time USGS CFS readings and timestamps
-def fetch_real_time_data():
-    real_time_values = {}
-    timestamps = {}
-
-    for creek, site in USGS_SITES.items():
-        url = f"https://waterservices.usgs.gov/nwis/iv/?format=json&sites={site}&parameterCd=00060"
-        response = requests.get(url, headers={"Accept": "application/json"})
-
-        if response.status_code == 200:
+# 🔹 Load Google Sheets Credentials and open the sheet predictions are recorded in
+# (cached, so a long-running LOOP process authenticates only once)
+@lru_cache(maxsize=None)
+def open_sheet():
+    import gspread
+
+    client = gspread.service_account(filename=CREDENTIALS_FILE)
+    return client.open(SHEET_NAME).sheet1  # Open the first sheet
+
+# 🔹 Load the trained XGBoost booster from its native export (scpm2.ubj, re-exported from
+# scpm2.pkl whenever the pickle changes), returning it with its row builder, or None if
+# the pickle is missing. Importing xgboost is the slow part, so this only runs once a
+# valid real-time reading is in hand.
+# A LOOP process keeps the loaded model between ticks but checks scpm2.pkl every tick,
+# reloading after a retrain; a missing pickle isn't remembered, so the next tick retries.
+MODEL_PATH = os.path.join(os.path.dirname(__file__), "scpm2.ubj")
+PICKLE_PATH = os.path.join(os.path.dirname(__file__), "scpm2.pkl")
+loaded_model = None
+
+def load_model():
+    global loaded_model
+    try:
+        stat = os.stat(PICKLE_PATH)
+    except FileNotFoundError:
+        return None
+    version = (stat.st_mtime_ns, stat.st_size)
+    if loaded_model is not None and loaded_model[0] == version:
+        return loaded_model[1]
+
+    booster = load_booster(PICKLE_PATH, MODEL_PATH)
+    # Predict straight from the booster; a single row gains nothing from a thread pool
+    booster.set_param({"nthread": 1})
+    # Feature order as saved with the booster, compiled once into the row builder
+    features = tuple(booster.feature_names)
+    extract_features = make_feature_extractor(features)
+
+    # The fetched readings and lags are fixed by USGS_SITES and LAG_HOURS, so check as
+    # the model loads that they cover its features rather than aligning columns every run
+    fetched = {*USGS_SITES, *(f"{creek}_{lag}" for creek in USGS_SITES for lag in LAG_HOURS)}
+    missing = [feature for feature in features if feature not in fetched]
+    if missing:
+        print(f"⚠️ Model features never fetched (passed as NaN): {', '.join(missing)}")
+    loaded_model = version, (booster, extract_features)
+    return loaded_model[1]
+
+# 🔹 Timestamps are recorded in Central Time
+CENTRAL_TZ = ZoneInfo("America/Chicago")
+
+# 🔹 Past readings never change, so every reading fetched for the lags is kept on disk
+# between runs. The reference moves forward each run, but the next run's Lag3/Lag7
+# fall inside the range already fetched, leaving only a narrow window around Lag1 to
+# query. Readings older than the longest lag plus a day are never needed again.
+LAG_MEMO_PATH = os.path.join(os.path.dirname(__file__), "lag_memo")
+LAG_MEMO_RETENTION = timedelta(hours=max(LAG_HOURS.values()) + 24).total_seconds()
+
+# 🔹 Memo key for a site's reading at an exact time (epoch seconds)
+def lag_memo_key(site, epoch_seconds):
+    return f"{site}:{int(epoch_seconds)}"
+
+# 🔹 Parse a USGS time series once into parallel arrays of reading times (epoch seconds)
+# and flows; a missing or malformed series gives empty arrays
+def parse_readings(time_series):
+    if time_series is None:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+    import pandas as pd
+
+    try:
+        values = time_series["values"][0]["value"]
+        entry_times = pd.to_datetime([entry["dateTime"] for entry in values], format="ISO8601", utc=True)
+        times = np.asarray(entry_times.tz_convert(None), dtype="datetime64[s]").astype(np.int64)
+        flows = np.fromiter((float(entry["value"]) for entry in values), dtype=np.float64, count=len(values))
+        return times, flows
+    except (KeyError, IndexError, TypeError, ValueError):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+# 🔹 Pick the reading closest to each target timestamp. USGS returns readings in time
+# order, so binary-search each target and compare only its two neighbours.
+# Only readings within 30 minutes of a target count; anything further is NaN.
+def nearest_readings(times, flows, target_timestamps):
+    if len(times) == 0:
+        return [np.nan] * len(target_timestamps)
+
+    targets = np.fromiter((target.timestamp() for target in target_timestamps), dtype=np.float64, count=len(target_timestamps))
+    after = np.searchsorted(times, targets)
+    before = np.clip(after - 1, 0, len(times) - 1)
+    after = np.clip(after, 0, len(times) - 1)
+    closest = np.where(np.abs(times[before] - targets) <= np.abs(times[after] - targets), before, after)
+    nearest = np.where(np.abs(times[closest] - targets) <= 30 * 60, flows[closest], np.nan)
+    return nearest.tolist()
+
+# 🔹 Fetch Historical Data for every creek and lag, reusing readings memoized on disk
+# and fetching the rest in a single multi-site request spanning the oldest to the newest lag
+async def fetch_historical_data(session, reference_timestamp):
+    # The recorded timestamp is Central wall-clock time without an offset; attach the zone
+    # so the lag targets, request window, and memo keys don't depend on the host's time zone
+    reference_time = datetime.fromisoformat(reference_timestamp).replace(tzinfo=CENTRAL_TZ)
+    targets = {lag: reference_time - timedelta(hours=hours_ago) for lag, hours_ago in LAG_HOURS.items()}
+
+    lag_data = {}
+    with shelve.open(LAG_MEMO_PATH) as memo:
+        for creek, site in USGS_SITES.items():
+            for lag, target in targets.items():
+                key = lag_memo_key(site, target.timestamp())
+                if key in memo:
+                    lag_data[f"{creek}_{lag}"] = memo[key]
+
+        # Only ask USGS for the lags some creek is still missing
+        missing = {
+            lag: target for lag, target in targets.items()
+            if any(f"{creek}_{lag}" not in lag_data for creek in USGS_SITES)
+        }
+        if missing:
+            series = series_by_creek(await fetch_json(session, historical_url(list(missing.values()))))
+
+            for creek, site in USGS_SITES.items():
+                times, flows = parse_readings(series.get(creek))
+                for epoch_seconds, flow in zip(times.tolist(), flows.tolist()):
+                    memo[lag_memo_key(site, epoch_seconds)] = flow
+
+                values = nearest_readings(times, flows, list(missing.values()))
+                for (lag, target), value in zip(missing.items(), values):
+                    lag_data.setdefault(f"{creek}_{lag}", value)
+                    # Also keep the resolved value under the target itself, in case
+                    # USGS has no reading at that exact time
+                    if not np.isnan(value):
+                        memo[lag_memo_key(site, target.timestamp())] = value
+
+        # Drop readings too old to be needed again
+        oldest = time.time() - LAG_MEMO_RETENTION
+        for key in [key for key in memo if int(key.rsplit(":", 1)[1]) < oldest]:
+            del memo[key]
+
+    return {f"{creek}_{lag}": lag_data[f"{creek}_{lag}"] for creek in USGS_SITES for lag in LAG_HOURS}
+
+# 🔹 Open the sheet and read the timestamps already recorded in it.
+# Only the timestamp column is needed for the duplicate check, not the whole sheet;
+# held as a set so the membership test doesn't scan the full history.
+def read_recorded_timestamps():
+    sheet = open_sheet()
+    return sheet, set(sheet.col_values(1)[1:])  # Skip header row
+
+# 🔹 Fetch, predict, and record one Sugar Creek reading, returning False if the run failed.
+# The duplicate check runs as soon as the real-time timestamp is known, so a run that
+# lands on an already-recorded reading skips the lag fetch, model load, and prediction.
+async def record_prediction():
+    # 🔹 Open the sheet in a worker thread while the real-time readings download
+    sheet_task = asyncio.create_task(asyncio.to_thread(read_recorded_timestamps))
+
+    # Every run asks for a different lag window, so a response cache would never be read
+    async with usgs_session(cached=False) as session:
+        real_time_data, reading_times = await fetch_real_time_data(session)
+
+        # 🔹 Ensure we have a valid timestamp and reading (Shoal Creek used as reference);
+        # a NaN reading never compares equal to np.nan, so check it with math.isfinite
+        reference_time = reading_times["Shoal_Creek"]
+        if reference_time is None or not math.isfinite(real_time_data["Shoal_Creek"]):
+            print("❌ No valid timestamp found. Exiting.")
+            # Still wait for the sheet so its errors (e.g. bad credentials) are reported
             try:
-                data = response.json()
-                time_series = data["value"]["timeSeries"][0]
-                latest_value_entry = time_series["values"][0]["value"][0]
-
-                real_time_values[creek] = float(latest_value_entry["value"])
-                raw_timestamp = latest_value_entry["dateTime"]
-
-                # Convert to UTC and then to Central Time
-                parsed_timestamp = datetime.strptime(raw_timestamp, "%Y-%m-%dT%H:%M:%S.%f%z")
-                central_tz = pytz.timezone("America/Chicago")
-                formatted_timestamp = parsed_timestamp.astimezone(central_tz).strftime("%Y-%m-%d %H:%M:%S")
-
-                timestamps[creek] = formatted_timestamp
-            except (KeyError, IndexError, TypeError, ValueError):
-                real_time_values[creek] = np.nan
-                timestamps[creek] = "N/A"
-        else:
-            real_time_values[creek] = np.nan
-            timestamps[creek] = "N/A"
-
-    return real_time_values, timestamps
-
-# 🔹 Fetch Historical Data
-def fetch_historical_data(site, reference_timestamp, hours_ago):
-    target_timestamp = datetime.strptime(reference_timestamp, "%Y-%m-%d %H:%M:%S") - timedelta(hours=hours_ago)
-    start_time = (target_timestamp - timedelta(minutes=30)).strftime('%Y-%m-%dT%H:%M:%SZ')
-    end_time = (target_timestamp + timedelta(minutes=30)).strftime('%Y-%m-%dT%H:%M:%SZ')
-
-    url = f"https://waterservices.usgs.gov/nwis/iv/?format=json&sites={site}&parameterCd=00060&startDT={start_time}&endDT={end_time}"
-    response = requests.get(url, headers={"Accept": "application/json"})
-
-    if response.status_code == 200:
-        try:
-            data = response.json()
-            time_series = data["value"]["timeSeries"][0]
-            values = time_series["values"][0]["value"]
-
-            closest_value, min_time_diff = np.nan, float("inf")
-
-            for entry in values:
-                entry_time = datetime.strptime(entry["dateTime"], "%Y-%m-%dT%H:%M:%S.%f%z").astimezone(pytz.utc)
-                time_diff = abs((entry_time - target_timestamp.astimezone(pytz.utc)).total_seconds())
-
-                if time_diff < min_time_diff:
-                    min_time_diff = time_diff
-                    closest_value = float(entry["value"])
-
-            return closest_value
-        except (KeyError, IndexError, TypeError, ValueError):
-            return np.nan
-    else:
-        return np.nan
-
-# 🔹 Fetch Real-Time Data
-real_time_data, timestamps = fetch_real_time_data()
-
-# 🔹 Ensure we have a valid timestamp (Shoal Creek used as reference)
-reference_timestamp = timestamps.get("Shoal_Creek", "N/A")
-if reference_timestamp == "N/A":
-    print("❌ No valid timestamp found. Exiting.")
-    exit(1)
-
-# 🔹 Fetch historical lag values for **all relevant creeks**
-lag_data = {}
-for creek, site in USGS_SITES.items():
-    if reference_timestamp != "N/A":
-        lag_data[f"{creek}_Lag1"] = fetch_historical_data(site, reference_timestamp, 24)
-        lag_data[f"{creek}_Lag3"] = fetch_historical_data(site, reference_timestamp, 72)
-        lag_data[f"{creek}_Lag7"] = fetch_historical_data(site, reference_timestamp, 168)
-
-# 🔹 Prepare Model Input
-model_input = pd.DataFrame([{**real_time_data, **lag_data}])
-
-# Ensure model input matches trained model's expected features
-for feature in xgb_model.feature_names_in_:
-    if feature not in model_input.columns:
-        model_input[feature] = np.nan  # Add missing columns with NaN values
-
-# Select only the required columns
-model_input = model_input[xgb_model.feature_names_in_]
-
-# 🔹 Run Prediction
-prediction = xgb_model.predict(model_input)[0]
-
-# 🔹 Store only Sugar Creek data in Google Sheets
-existing_data = sheet.get_all_values()
-timestamps_in_sheet = [row[0] for row in existing_data[1:]]  # Skip header row
-
-if reference_timestamp not in timestamps_in_sheet:
-    # ✅ Append only one row per prediction
-    sheet.append_row([reference_timestamp, float(prediction)])
+                await sheet_task
+            except Exception as e:
+                print(f"❌ Could not read the sheet: {e}")
+            return False
+        reference_timestamp = reference_time.astimezone(CENTRAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
+
+        sheet, timestamps_in_sheet = await sheet_task
+        if reference_timestamp in timestamps_in_sheet:
+            print(f"⚠️ Duplicate entry detected. Skipping {reference_timestamp}")
+            return True
+
+        # 🔹 Load the model in a worker thread while the lag values download
+        model_task = asyncio.create_task(asyncio.to_thread(load_model))
+
+        # 🔹 Fetch historical lag values for **all relevant creeks**
+        lag_data = await fetch_historical_data(session, reference_timestamp)
+        model = await model_task
+
+    if model is None:
+        print("❌ Model file 'scpm2.pkl' not found.")
+        return False
+    booster, extract_features = model
+
+    # 🔹 Prepare Model Input as a float32 row in the trained model's feature order
+    # (features missing from the fetched data are passed as NaN)
+    model_input = extract_features({**real_time_data, **lag_data})
+
+    # 🔹 Run Prediction
+    prediction = float(booster.inplace_predict(model_input)[0])
+    if not math.isfinite(prediction):
+        print(f"❌ Prediction for {reference_timestamp} is not a number. Exiting.")
+        return False
+
+    # ✅ Store only Sugar Creek data, one row per prediction, stored as-is (RAW skips
+    # formula parsing) and inserted as a new row rather than overwriting whatever follows the table
+    sheet.append_row([reference_timestamp, prediction], value_input_option="RAW", insert_data_option="INSERT_ROWS")
     print(f"✅ Recorded: {reference_timestamp} - Sugar Creek Prediction: {prediction:.2f} CFS")
-else:
-    print(f"⚠️ Duplicate entry detected. Skipping {reference_timestamp}")
+    return True
+
+# 🔹 Seconds between readings when running as a long-lived process
+RECORD_INTERVAL = 300
+
+# 🔹 Run one fetch-predict-record pass, returning False if it failed
+def tick():
+    return asyncio.run(record_prediction())
+
+# 🔹 Record once (for the scheduled workflow), or set LOOP=1 to keep recording every
+# RECORD_INTERVAL seconds with the sheet client and model kept between ticks
+def main():
+    if os.getenv("LOOP"):
+        while True:
+            try:
+                tick()
+            except Exception as e:
+                print(f"❌ Recording failed: {e}")
+            time.sleep(RECORD_INTERVAL)
+
+    # A failed run exits non-zero so the scheduled workflow reports it
+    if not tick():
+        exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import asyncio
+import time
+import aiohttp
+import orjson
+from aiohttp_client_cache import CachedSession, SQLiteBackend
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlsplit
+
+# 🔹 Shared USGS helpers for the Streamlit pages and record_real_time.py: the sites the
+# model uses and the USGS session and fetch/parse helpers.
+
+# 🔹 USGS Creek Sites (same ones used in the model)
+USGS_SITES = {
+    "Shoal_Creek": "03588500",
+    "Big_Nance_Creek": "03586500",
+    "Limestone_Creek": "03576250",
+    "Swan_Creek": "03577225",
+}
+SITE_CREEKS = {site: creek for creek, site in USGS_SITES.items()}
+
+# 🔹 Seconds to wait on a single USGS request
+USGS_TIMEOUT = 10
+
+# 🔹 Retry transient USGS gateway and connection errors with exponential backoff (0.3 s, 0.6 s, 1.2 s)
+USGS_RETRIES = 3
+RETRY_STATUSES = (502, 503, 504)
+
+# 🔹 USGS request URLs, built once: the real-time query covers every site and never
+# changes, and historical queries only fill in the sites and time window
+ALL_SITES = ",".join(USGS_SITES.values())
+REAL_TIME_URL = f"https://waterservices.usgs.gov/nwis/iv/?format=json&sites={ALL_SITES}&parameterCd=00060"
+HISTORICAL_URL_TEMPLATE = "https://waterservices.usgs.gov/nwis/iv/?format=json&sites={sites}&parameterCd=00060&startDT={start}&endDT={end}"
+
+# 🔹 Lag features used by the model, in hours before the real-time reading
+LAG_HOURS = {"Lag1": 24, "Lag3": 72, "Lag7": 168}
+
+# 🔹 Open a USGS session, backed by an on-disk response cache unless cached=False
+# (see usgs_expire_after for how long responses are kept)
+def usgs_session(cached=True):
+    # One keep-alive connection pool shared by every request in the session;
+    # a stalled USGS request gives up after USGS_TIMEOUT seconds instead of hanging
+    options = dict(
+        connector=aiohttp.TCPConnector(limit=16),
+        headers={"Accept": "application/json"},
+        timeout=aiohttp.ClientTimeout(total=USGS_TIMEOUT),
+    )
+    if not cached:
+        return aiohttp.ClientSession(**options)
+    return CachedSession(cache=SQLiteBackend("usgs_cache", expire_after=300, allowed_codes=(200,)), **options)
+
+# 🔹 How long to cache a USGS response. Readings in a window that ended more than a day
+# ago are final, so it is kept for 30 days; anything more recent (including real-time
+# queries and windows USGS hasn't filled in yet) expires after 5 minutes.
+def usgs_expire_after(url):
+    end = parse_qs(urlsplit(url).query).get("endDT")
+    if end and datetime.now(timezone.utc) - datetime.fromisoformat(end[0]) > timedelta(days=1):
+        return timedelta(days=30)
+    return 300
+
+# 🔹 Drop expired responses from the on-disk cache at most once an hour per process;
+# aiohttp-client-cache only removes an expired entry when the same URL is requested again
+USGS_CACHE_PURGE_INTERVAL = 3600
+last_cache_purge = None
+
+async def purge_usgs_cache(session):
+    global last_cache_purge
+    if last_cache_purge is not None and time.monotonic() - last_cache_purge < USGS_CACHE_PURGE_INTERVAL:
+        return
+    last_cache_purge = time.monotonic()
+    await session.cache.delete_expired_responses()
+
+# 🔹 Fetch and decode a USGS JSON payload, returning None on a failed request so one bad
+# request doesn't abort the others. Gateway and connection errors are retried; a timeout
+# has already waited USGS_TIMEOUT seconds, so it is not.
+async def fetch_json(session, url):
+    for attempt in range(USGS_RETRIES + 1):
+        try:
+            # Cached sessions take a per-request expiry; a plain session takes none
+            options = {"expire_after": usgs_expire_after(url)} if isinstance(session, CachedSession) else {}
+            async with session.get(url, **options) as response:
+                if response.status == 200:
+                    try:
+                        return orjson.loads(await response.read())
+                    except orjson.JSONDecodeError as e:
+                        print(f"⚠️ Error decoding USGS data: {e}")
+                        return None
+                if response.status not in RETRY_STATUSES:
+                    print(f"❌ Failed to fetch USGS data. HTTP Status: {response.status}")
+                    return None
+                failure = f"HTTP Status: {response.status}"
+        # Checked first: aiohttp's socket timeouts are also ClientErrors
+        except asyncio.TimeoutError as e:
+            print(f"❌ Failed to fetch USGS data: {e!r}")
+            return None
+        except aiohttp.ClientError as e:
+            failure = repr(e)
+        if attempt < USGS_RETRIES:
+            await asyncio.sleep(0.3 * 2 ** attempt)
+    print(f"❌ Failed to fetch USGS data after {USGS_RETRIES} retries. {failure}")
+    return None
+
+# 🔹 Map each time series in a multi-site USGS payload back to its creek
+# (a failed request comes through as None)
+def series_by_creek(data):
+    series = {}
+    if data is None:
+        return series
+
+    try:
+        for time_series in data["value"]["timeSeries"]:
+            creek = SITE_CREEKS.get(time_series["sourceInfo"]["siteCode"][0]["value"])
+            if creek is not None:
+                series.setdefault(creek, time_series)
+    except (KeyError, IndexError, TypeError):
+        pass
+    return series
+
+# 🔹 Fetch the latest reading for every creek in one request, returning each creek's flow
+# and reading time (timezone-aware, as USGS reports it); a creek without a usable reading
+# gets NaN and None, and if the request fails every creek does
+async def fetch_real_time_data(session):
+    real_time_values = {}
+    reading_times = {}
+
+    series = series_by_creek(await fetch_json(session, REAL_TIME_URL))
+
+    for creek in USGS_SITES:
+        try:
+            latest_value_entry = series[creek]["values"][0]["value"][0]
+            real_time_values[creek] = float(latest_value_entry["value"])
+            reading_times[creek] = datetime.fromisoformat(latest_value_entry["dateTime"])
+        except (KeyError, IndexError, TypeError, ValueError):
+            real_time_values[creek] = float("nan")
+            reading_times[creek] = None
+
+    return real_time_values, reading_times
+
+# 🔹 Build the USGS URL covering the given sites from 30 minutes before the earliest
+# target timestamp to 30 minutes after the latest (sent to USGS in UTC)
+def historical_url(target_timestamps, sites=USGS_SITES.values()):
+    start_time = (min(target_timestamps) - timedelta(minutes=30)).astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    end_time = (max(target_timestamps) + timedelta(minutes=30)).astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    return HISTORICAL_URL_TEMPLATE.format(sites=",".join(sites), start=start_time, end=end_time)